@@ -1,20 +1,36 @@
 # tracking.py — robusto para GitHub Actions, con debugging
-import os, sys, re, json, pytz, time, warnings
+import os, sys, re, json, hashlib, queue, shutil, tempfile, threading, warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from pathlib import Path
 from dotenv import load_dotenv
 
+# HTTP directo (sin navegador)
+import requests
+from selectolax.parser import HTMLParser
+
+try:
+    import orjson  # parser JSON en C; opcional
+except ImportError:
+    orjson = None
+
 # Google Sheets
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-
-# Selenium
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
+from google.oauth2.service_account import Credentials
+
+# Selenium (opcional: el job PyPy solo usa la ruta HTTP)
+try:
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options as ChromeOptions
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import (
+        JavascriptException, StaleElementReferenceException, TimeoutException, WebDriverException,
+    )
+except ImportError:
+    webdriver = None
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 load_dotenv()
@@ -24,10 +40,29 @@ SHEET_ID         = os.getenv("SHEET_ID")
 TAB_TRACKING     = os.getenv("TAB_TRACKING", "Tracking")
 RUN_HEADLESS     = (os.getenv("RUN_HEADLESS", "true").strip().lower() in {"1","true","yes","y"})
 PAGELOAD_TIMEOUT = int(os.getenv("PAGELOAD_TIMEOUT", "35"))
-IMPLICIT_WAIT    = int(os.getenv("IMPLICIT_WAIT", "10"))
 CHROME_BINARY    = (os.getenv("CHROME_BINARY") or "").strip()
-
-LA_PAZ = pytz.timezone("America/La_Paz")
+FILTER_CELL      = (os.getenv("FILTER_CELL") or "").strip()  # p.ej. "Z1" con fórmula FILTER (ver pending_rows)
+CACHE_FILE       = Path(os.getenv("TRACKING_CACHE", "cache.json"))  # código -> hash del último estado y filas escritas
+CHROME_CACHE_DIR = (os.getenv("CHROME_CACHE_DIR") or "").strip()  # vacío = /dev/shm si hay espacio, si no tmp
+WORKERS          = max(1, int(os.getenv("WORKERS", "4")))  # navegadores en paralelo
+HTTP_TIMEOUT     = int(os.getenv("HTTP_TIMEOUT", "10"))
+SELENIUM_FALLBACK = (os.getenv("SELENIUM_FALLBACK", "true").strip().lower() in {"1","true","yes","y"}
+                     and webdriver is not None)
+HTTP_FIRST       = (os.getenv("HTTP_FIRST", "true").strip().lower() in {"1","true","yes","y"})
+ONLY_CODES       = {c.strip() for c in (os.getenv("ONLY_CODES") or "").split(",") if c.strip()}  # vacío = todos
+
+BLOCKED_URLS = [
+    "*google-analytics*", "*googletagmanager*", "*gtag*", "*facebook*", "*hotjar*",
+    "*.woff", "*.woff2", "*.ttf", "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.webp",
+]
+
+HTTP_HEADERS = {
+    "User-Agent": ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                   "(KHTML, like Gecko) Chrome/126.0 Safari/537.36"),
+    "Accept-Language": "es",
+}
+
+LA_PAZ = ZoneInfo("America/La_Paz")
 
 # Mapeo columnas (1-based)
 COL_CONTENT = 1  # A: Contenido (manual)
@@ -39,6 +74,23 @@ COL_UPDATED = 6  # F: Última actualización
 COL_OBS     = 7  # G: Observación
 COL_DONE    = 8  # H: Control ("OK" = omitir)
 
+# Letras de columna precalculadas (rowcol_to_a1 también cubre AA, AB, ...)
+_COL = {k: gspread.utils.rowcol_to_a1(1, v)[:-1] for k, v in {
+    "CODE": COL_CODE, "STATUS": COL_STATUS, "CARRIER": COL_CARRIER, "UPDATED": COL_UPDATED,
+    "OBS": COL_OBS, "DONE": COL_DONE,
+}.items()}
+
+BATCH_ROWS = 500  # filas por llamada batch_update
+
+DISK_CACHE_SIZE  = 100_000_000  # bytes de caché HTTP por Chrome
+PROFILE_OVERHEAD = 50_000_000   # resto del perfil (aprox.)
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj, ensure_ascii=False)
+
 def now_bo():
     return datetime.now(LA_PAZ).strftime("%Y-%m-%d %H:%M:%S %z")
 
@@ -48,10 +100,10 @@ def creds_from_env():
     json_inline = (os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON") or "").strip()
     file_path   = (os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or "").strip()
     if json_inline:
-        data = json.loads(json_inline)
-        return ServiceAccountCredentials.from_json_keyfile_dict(data, scopes=scopes)
+        data = json_loads(json_inline)
+        return Credentials.from_service_account_info(data, scopes=scopes)
     if file_path:
-        return ServiceAccountCredentials.from_json_keyfile_name(file_path, scopes=scopes)
+        return Credentials.from_service_account_file(file_path, scopes=scopes)
     raise RuntimeError("Faltan credenciales: define GOOGLE_SERVICE_ACCOUNT_JSON o GOOGLE_APPLICATION_CREDENTIALS")
 
 def open_ws():
@@ -60,8 +112,20 @@ def open_ws():
     gc = gspread.authorize(creds_from_env())
     return gc.open_by_key(SHEET_ID).worksheet(TAB_TRACKING)
 
-def build_driver():
+def chrome_cache_dir(slots):
+    """/dev/shm (memoria) solo si tiene espacio para todos los perfiles; en Docker suele ser de 64 MB."""
+    if CHROME_CACHE_DIR:
+        return CHROME_CACHE_DIR
+    try:
+        if shutil.disk_usage("/dev/shm").free >= slots * (DISK_CACHE_SIZE + PROFILE_OVERHEAD):
+            return "/dev/shm"
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+def build_driver(profile_dir=None):
     opts = ChromeOptions()
+    opts.page_load_strategy = "eager"  # driver.get vuelve en DOMContentLoaded; el timeline se espera aparte
     if RUN_HEADLESS:
         opts.add_argument("--headless")         # más compatible en CI
         opts.add_argument("--disable-gpu")
@@ -71,199 +135,477 @@ def build_driver():
     opts.add_argument("--no-first-run")
     opts.add_argument("--no-default-browser-check")
     opts.add_argument("--disable-background-networking")
+    # Sin imágenes/CSS/fuentes: solo interesa el texto del timeline
+    opts.add_argument("--blink-settings=imagesEnabled=false")
+    opts.add_argument("--disable-extensions")
+    opts.add_argument("--disable-sync")
+    opts.add_argument("--disable-translate")
+    opts.add_argument("--mute-audio")
+    opts.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.managed_default_content_settings.stylesheets": 2,
+        "profile.managed_default_content_settings.fonts": 2,
+        "profile.default_content_setting_values.notifications": 2,
+    })
+    # Perfil propio con caché HTTP: las cargas siguientes sirven JS/CSS del sitio desde caché
+    if profile_dir:
+        opts.add_argument(f"--user-data-dir={profile_dir}")
+        opts.add_argument(f"--disk-cache-dir={os.path.join(profile_dir, 'cache')}")
+        opts.add_argument(f"--disk-cache-size={DISK_CACHE_SIZE}")
     if CHROME_BINARY:
         opts.binary_location = CHROME_BINARY
 
     d = webdriver.Chrome(options=opts)  # Selenium Manager resuelve el driver
     d.set_page_load_timeout(PAGELOAD_TIMEOUT)
-    d.implicitly_wait(IMPLICIT_WAIT)
+    d.implicitly_wait(0)  # solo esperas explícitas (WebDriverWait)
+    try:
+        # Corta analytics y assets pesados a nivel de red
+        d.execute_cdp_cmd("Network.enable", {})
+        d.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+        d.execute_cdp_cmd("Network.setCacheDisabled", {"cacheDisabled": False})
+    except Exception:
+        pass
     return d
 
-def tiny_sleep(s=1.2): time.sleep(s)
+class DriverPool:
+    """
+    Pool de hasta `size` Chrome; los crea bajo demanda y los reparte entre hilos.
+    Cada uno usa un perfil temporal propio que se borra en quit().
+    """
+    def __init__(self, size):
+        self.size = size
+        self._free = queue.Queue()
+        self._all = []
+        self._dirs = []
+        self._base = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                if self._base is None:
+                    self._base = chrome_cache_dir(self.size)
+                profile = tempfile.mkdtemp(prefix="chrome-profile-", dir=self._base)
+                self._dirs.append(profile)
+                d = build_driver(profile)
+                self._all.append(d)
+                return d
+        return self._free.get()
+
+    def release(self, d):
+        self._free.put(d)
+
+    def quit(self):
+        for d in self._all:
+            try: d.quit()
+            except Exception: pass
+        for p in self._dirs:
+            shutil.rmtree(p, ignore_errors=True)
 
 def save_debug(driver, label=""):
-    """Guarda HTML y captura para inspección (Actions subirá como artefacto)."""
+    """
+    Guarda HTML y captura para inspección (Actions subirá como artefacto).
+    El label incluye el código para que los workers en paralelo no se pisen los archivos.
+    """
     try:
         p = Path(f"pagina_debug{('-' + label) if label else ''}.html")
         p.write_text(driver.page_source, encoding="utf-8")
     except Exception:
         pass
     try:
-        driver.save_screenshot("last_page.png")
+        driver.save_screenshot(f"last_page{('-' + label) if label else ''}.png")
     except Exception:
         pass
 
 # --------- helpers scraping ----------
+_STATUS_CANDIDATES = [
+    "Delivered","Entregado","En tránsito","In Transit","Out for delivery",
+    "Llegó a","Despachado","Salida","Arribo","Procesado",
+    "Información recibida","Label created","Recibido por Distribuidor"
+]
+_CARRIERS = ["Correo","UPS","DHL","USPS","Bolivia","MailAmericas",
+             "La Paz","Santa Cruz","Cochabamba"]
+_STATUS_LC   = [(c, c.lower()) for c in _STATUS_CANDIDATES]
+_CARRIERS_LC = [(k, k.lower()) for k in _CARRIERS]
+_DATE_RE     = re.compile(r"(\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{2,4})")
+
+# Unión de estados escapada para RegExp de JS (se compila en el navegador con flag 'i')
+_STATUS_RE   = "|".join(re.sub(r"[.*+?^${}()|[\]\\/]", r"\\\g<0>", c) for c in _STATUS_CANDIDATES)
+
+# Un solo recorrido en el orden de _COLLECT_SELECTORS: [¿tiene estado?, texto] por nodo (sin repetidos)
+_COLLECT_JS = """
+const prefix = arguments[0], re = new RegExp(arguments[2], 'i'), seen = new Set(), out = [];
+for (const css of arguments[1]) {
+  for (const e of document.querySelectorAll(css)) {
+    const t = (e.innerText || '').trim();
+    if (!t || seen.has(t) || !(t.includes(prefix) || t.length > 20)) continue;
+    seen.add(t);
+    out.push([re.test(t), t]);
+  }
+}
+return out;
+"""
+_COLLECT_SELECTORS = [
+    "div[class*='result']","div[class*='tracking']","div[class*='event']",
+    "section","table","tbody","tr","li","p"
+]
+
 def _collect_texts(driver, code: str):
-    texts = []
-    for css in [
-        "div[class*='result']","div[class*='tracking']","div[class*='event']",
-        "section","table","tbody","tr","li","p","div"
-    ]:
-        try:
-            for el in driver.find_elements(By.CSS_SELECTOR, css):
-                t = (el.text or "").strip()
-                if t and (code[:6] in t or len(t) > 20):
-                    texts.append(t)
-        except Exception:
-            pass
-    return texts
+    """[(tiene_estado, texto)] en un solo execute_script; el filtro por estado corre en el navegador."""
+    try:
+        return driver.execute_script(_COLLECT_JS, code[:6], _COLLECT_SELECTORS, _STATUS_RE) or []
+    except WebDriverException:
+        return []
+
+def _classify(status, t):
+    m = _DATE_RE.search(t)
+    tl = t.lower()
+    carrier = next((k for k, lk in _CARRIERS_LC if lk in tl), None)
+    return status, (m.group(1) if m else None), carrier
 
 def _infer_status_when_carrier(texts):
-    status_candidates = [
-        "Delivered","Entregado","En tránsito","In Transit","Out for delivery",
-        "Llegó a","Despachado","Salida","Arribo","Procesado",
-        "Información recibida","Label created","Recibido por Distribuidor"
-    ]
-    status = when = carrier = None
     for t in texts:
-        if not status:
-            for c in status_candidates:
-                if c.lower() in t.lower():
-                    status = c; break
+        tl = t.lower()
+        status = next((c for c, lc in _STATUS_LC if lc in tl), None)
         if status:
-            m = re.search(r"(\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{2,4})", t)
-            when = m.group(1) if m else None
-            for k in ["Correo","UPS","DHL","USPS","Bolivia","MailAmericas",
-                      "La Paz","Santa Cruz","Cochabamba"]:
-                if k.lower() in t.lower():
-                    carrier = k; break
-            break
-    return status or "Sin clasificar", when, carrier
+            return _classify(status, t)
+    return "Sin clasificar", None, None
 
-# --------- extractor principal (solo último evento) ----------
-def fetch_status_mailamericas(driver, code: str):
-    """
-    Devuelve (status, when, carrier, observation) del ÚLTIMO evento.
-    Hace varios intentos (URLs, espera extendida, scroll) y si falla guarda HTML/PNG.
-    """
-    candidate_urls = [
+def _candidate_urls(code: str):
+    return [
         f"https://www.mailamericas.com/tracking?tracking={code}",
         f"https://mailamericas.com/tracking?tracking={code}",
         f"https://tracking.mailamericas.com/?tracking={code}",
         f"https://tracking.mailamericas.com/track?tracking={code}",
     ]
 
-    for attempt, url in enumerate(candidate_urls, start=1):
+def _node_text(node):
+    return " ".join(node.text(separator=" ").split())
+
+def _parse_steps_html(html: str):
+    """Primer .process-step con título en el HTML -> (status, when, carrier, observation) o None."""
+    tree = HTMLParser(html)
+    for step in tree.css("div.process-step"):
+        left  = step.css_first("div.process-step-content div.form-row div.col-md-7")
+        right = step.css_first("div.process-step-content div.form-row div.col-md-5")
+        if left is None or right is None:
+            continue
+
+        title = ""
+        for sel in ["p.h6", "p.font-weight-bold", "p.text-md-left.h6", "p"]:
+            el = left.css_first(sel)
+            if el is not None:
+                title = _node_text(el)
+                if title: break
+        if not title:
+            continue
+
+        ps = left.css("p")
+        observation = _node_text(ps[1]) if len(ps) >= 2 else ""
+
+        when = ""
+        for el in right.css("span, time, p, div"):
+            t = _node_text(el)
+            if len(t) >= 8:
+                when = t; break
+
+        return title, when, "MailAmericas / Correo destino", observation[:900]
+    return None
+
+_http = threading.local()
+
+def _http_session():
+    """Una requests.Session por hilo (reutiliza conexiones keep-alive)."""
+    s = getattr(_http, "session", None)
+    if s is None:
+        s = _http.session = requests.Session()
+        s.headers.update(HTTP_HEADERS)
+    return s
+
+def _validators(url, r):
+    v = {"url": url, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+    return v if v["etag"] or v["last_modified"] else None
+
+def http_not_modified(entry):
+    """GET condicional a la URL cacheada; True si el servidor responde 304 (sin cambios)."""
+    if not entry or not entry.get("url"):
+        return False
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    if not headers:
+        return False
+    try:
+        r = _http_session().get(entry["url"], headers=headers, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        return False
+    return r.status_code == 304
+
+def fetch_status_http(code: str):
+    """
+    Igual que fetch_status_mailamericas pero sin navegador: GET + parseo del HTML.
+    Devuelve (resultado, validators) con ETag/Last-Modified de la URL que respondió,
+    o (None, None) si ninguna URL trae el timeline renderizado en servidor.
+    """
+    session = _http_session()
+    for url in _candidate_urls(code):
+        try:
+            r = session.get(url, timeout=HTTP_TIMEOUT)
+        except requests.RequestException:
+            continue
+        if r.status_code != 200:
+            continue
+        res = _parse_steps_html(r.text)
+        if res:
+            return res, _validators(url, r)
+    return None, None
+
+# Extrae {title, obs, when} de cada div.process-step en el navegador (mismos selectores que _parse_steps_html)
+_STEPS_JS = """
+const txt = e => (e && e.innerText || '').trim();
+return Array.from(document.querySelectorAll('div.process-step')).map(s => {
+  const L = s.querySelector('div.process-step-content div.form-row div.col-md-7');
+  const R = s.querySelector('div.process-step-content div.form-row div.col-md-5');
+  if (!L || !R) return {title: '', obs: '', when: ''};
+  let title = '';
+  for (const sel of ['p.h6', 'p.font-weight-bold', 'p.text-md-left.h6', 'p']) {
+    title = txt(L.querySelector(sel));
+    if (title) break;
+  }
+  const ps = L.querySelectorAll('p');
+  const obs = ps.length >= 2 ? txt(ps[1]) : '';
+  let when = '';
+  for (const e of R.querySelectorAll('span, time, p, div')) {
+    const t = txt(e);
+    if (t.length >= 8) { when = t; break; }
+  }
+  return {title: title, obs: obs, when: when};
+});
+"""
+
+# Scroll suave (dispara lazy-load) + chequeo del timeline en un solo script por sondeo
+_READY_JS = ("window.scrollBy(0, 400);"
+             "return document.querySelector('div.process-vertical, div.process-step') !== null;")
+
+def _timeline_ready(driver):
+    return driver.execute_script(_READY_JS)
+
+# --------- extractor principal (solo último evento) ----------
+def fetch_status_mailamericas(driver, code: str):
+    """
+    Devuelve (status, when, carrier, observation) del ÚLTIMO evento.
+    Hace varios intentos (URLs, espera extendida, scroll) y si falla guarda HTML/PNG.
+    """
+    for attempt, url in enumerate(_candidate_urls(code), start=1):
         try:
             driver.get(url)
         except Exception:
             continue
 
-        # Espera extendida con scroll suave (hasta ~30s)
-        ok = False
-        start = time.time()
-        while time.time() - start < 30:
-            try:
-                # a) por si la página usa contenedor de timeline
-                timeline = driver.find_elements(By.CSS_SELECTOR, "div.process-vertical")
-                if timeline:
-                    ok = True
-                    break
-                # b) si no, busca items genéricos
-                if driver.find_elements(By.CSS_SELECTOR, "div.process-step"):
-                    ok = True
-                    break
-            except Exception:
-                pass
-            # pequeño scroll para disparar lazy-load
-            driver.execute_script("window.scrollBy(0, 400);")
-            tiny_sleep(0.8)
-
-        if not ok:
+        # Espera explícita del timeline (hasta ~30s); cada sondeo hace un scroll suave
+        try:
+            WebDriverWait(driver, 30, poll_frequency=0.2,
+                          ignored_exceptions=(JavascriptException, StaleElementReferenceException),
+                          ).until(_timeline_ready)
+        except TimeoutException:
             # guarda evidencia y prueba siguiente URL
-            save_debug(driver, f"no-timeline-{attempt}")
+            save_debug(driver, f"{code}-no-timeline-{attempt}")
             continue
 
         try:
-            steps = driver.find_elements(By.CSS_SELECTOR, "div.process-step")
+            # Una sola ida y vuelta al navegador para todos los steps
+            steps = driver.execute_script(_STEPS_JS)
             if not steps:
                 raise RuntimeError("No hay .process-step")
 
             for step in steps:
-                try:
-                    left  = step.find_element(By.CSS_SELECTOR, "div.process-step-content div.form-row div.col-md-7")
-                    right = step.find_element(By.CSS_SELECTOR, "div.process-step-content div.form-row div.col-md-5")
-                except Exception:
-                    continue
-
-                # título/estado
-                title = ""
-                for sel in ["p.h6", "p.font-weight-bold", "p.text-md-left.h6", "p"]:
-                    try:
-                        el = left.find_element(By.CSS_SELECTOR, sel)
-                        title = (el.text or "").strip()
-                        if title: break
-                    except Exception:
-                        pass
+                title = step.get("title") or ""
                 if not title:
                     continue
-
-                # descripción
-                observation = ""
-                try:
-                    ps = left.find_elements(By.CSS_SELECTOR, "p")
-                    if len(ps) >= 2:
-                        observation = (ps[1].text or "").strip()
-                except Exception:
-                    pass
-
-                # fecha/hora
-                when = ""
-                try:
-                    for el in right.find_elements(By.CSS_SELECTOR, "span, time, p, div"):
-                        t = (el.text or "").strip()
-                        if len(t) >= 8:
-                            when = t; break
-                except Exception:
-                    pass
-
                 carrier = "MailAmericas / Correo destino"
-                return title, when, carrier, observation[:900]
+                return title, step.get("when") or "", carrier, (step.get("obs") or "")[:900]
 
             # si ningún step tenía título, guardamos y probamos siguiente URL
-            save_debug(driver, f"no-title-{attempt}")
+            save_debug(driver, f"{code}-no-title-{attempt}")
         except Exception:
-            save_debug(driver, f"exception-{attempt}")
+            save_debug(driver, f"{code}-exception-{attempt}")
             # probar siguiente URL
             continue
 
-    # Fallback genérico: juntar texto y heurística
-    texts = _collect_texts(driver, code)
-    if not texts:
-        save_debug(driver, "sin-resultados")
+    # Fallback genérico: juntar texto (ya marcado por estado en el navegador) y heurística
+    entries = _collect_texts(driver, code)
+    if not entries:
+        save_debug(driver, f"{code}-sin-resultados")
         return None, None, None, "Sin resultados visibles"
 
+    hits = [t for has_status, t in entries if has_status]
+    texts = hits or [t for _, t in entries]
     status, when, carrier = _infer_status_when_carrier(texts)
     return status, when, carrier, " | ".join(texts)[:900]
 
 # --------- main ----------
+def flush_updates(ws, updates):
+    """
+    Escribe los registros (rango, valores, raw) acumulados en llamadas batch_update (BATCH_ROWS por llamada).
+    Los marcados raw (todo lo scrapeado, C:E y G) van con RAW para que Sheets no los interprete
+    como fórmulas; solo la marca de tiempo (F) va con USER_ENTERED.
+    """
+    for option, raw in (("USER_ENTERED", False), ("RAW", True)):
+        data = [{"range": r, "values": v} for r, v, is_raw in updates if is_raw == raw]
+        for k in range(0, len(data), BATCH_ROWS):
+            ws.batch_update(data[k:k+BATCH_ROWS], value_input_option=option)
+
+def load_cache():
+    try:
+        return json_loads(CACHE_FILE.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    try:
+        CACHE_FILE.write_text(json_dumps(cache), encoding="utf-8")
+    except OSError:
+        pass
+
+def _status_hash(status, when):
+    return hashlib.sha256(f"{status}|{when}".encode()).hexdigest()
+
+def _fetch_code(pool, code, rows, entry, ts):
+    """
+    Worker: consulta el código una vez por HTTP y, si hace falta, con un driver del pool.
+    `ts` es la marca de "Última actualización" de la corrida.
+    Devuelve (registros (rango, valores, raw) para cada fila de `rows`; nueva entrada de caché o None; resuelto).
+    Si el estado no cambió, solo se escriben las filas que no figuran en la entrada cacheada.
+    Sin Selenium, los códigos que el HTTP no resuelve no se escriben (quedan para el job con Chrome).
+    """
+    # Filas donde ya está escrito el estado cacheado; solo esas pueden saltarse
+    cached_rows = set(entry.get("rows", [])) if entry else set()
+    d = None
+    try:
+        if set(rows) <= cached_rows and http_not_modified(entry):
+            return [], {**entry, "rows": rows}, True
+        res, validators = fetch_status_http(code) if HTTP_FIRST else (None, None)
+        if res is None:
+            if not SELENIUM_FALLBACK:
+                return [], None, False
+            d = pool.acquire()
+            res = fetch_status_mailamericas(d, code)
+        status, when, carrier, obs = res or (None, None, None, "Sin resultados visibles")
+
+        new_entry, write_rows = None, rows
+        if status:
+            new_entry = {"hash": _status_hash(status, when), "rows": rows, **(validators or {})}
+            if entry and entry.get("hash") == new_entry["hash"]:
+                write_rows = [i for i in rows if i not in cached_rows]
+        values = [[status or "", when or "", carrier or ""]]
+        recs = []
+        for i in write_rows:
+            recs.append((f"{_COL['STATUS']}{i}:{_COL['CARRIER']}{i}", values, True))
+            recs.append((f"{_COL['UPDATED']}{i}", [[ts]], False))
+            recs.append((f"{_COL['OBS']}{i}", [[obs or ""]], True))
+        return recs, new_entry, True
+    except Exception as e:
+        recs = []
+        for i in rows:
+            recs.append((f"{_COL['UPDATED']}{i}", [[ts]], False))
+            recs.append((f"{_COL['OBS']}{i}", [[f"Error {type(e).__name__}"]], True))
+        return recs, None, True
+    finally:
+        if d is not None:
+            pool.release(d)
+
+def _pending_from_filter_cell(ws, cell):
+    """
+    Lee una celda con una fórmula que ya filtra en el servidor, p.ej.
+    =JOIN(";",FILTER(ROW(B2:B)&":"&B2:B, B2:B<>"", H2:H<>"OK"))
+    y devuelve [(fila, código)] a partir de "2:CODE;5:CODE;...".
+    Devuelve None si la fórmula da error (#REF!, #ERROR!, JOIN > 50k caracteres, ...).
+    """
+    values = ws.get(cell)
+    raw = str(values[0][0]) if values and values[0] else ""
+    if raw.startswith("#"):
+        print(f"{cell} devolvió {raw[:40]}; se leen las columnas B/H", file=sys.stderr)
+        return None
+    pending = []
+    for item in raw.split(";"):
+        row, sep, code = item.partition(":")
+        if sep and row.strip().isdigit() and code.strip():
+            pending.append((int(row), code.strip()))
+    return pending
+
+def pending_rows(ws):
+    """Filas a consultar: código no vacío y control distinto de "OK"."""
+    if FILTER_CELL:
+        pending = _pending_from_filter_cell(ws, FILTER_CELL)
+        if pending is not None:
+            return pending
+
+    # Solo las columnas B (código) y H (control), en un único batchGet
+    code_col, done_col = _COL["CODE"], _COL["DONE"]
+    # COLUMNS: cada rango llega como una sola lista [v2, v3, ...] en vez de una lista por fila
+    codes, dones = ws.batch_get([f"{code_col}2:{code_col}", f"{done_col}2:{done_col}"],
+                                major_dimension="COLUMNS",
+                                value_render_option="UNFORMATTED_VALUE")
+    codes = codes[0] if codes else []
+    dones = dones[0] if dones else []
+
+    pending = []
+    for off, code in enumerate(codes):
+        code = str(code).strip()
+        done = str(dones[off]).strip().lower() if off < len(dones) else ""
+        if code and done != "ok":
+            pending.append((off + 2, code))
+    return pending
+
 def main():
     ws = open_ws()
-    rows = ws.get_all_values()
-
-    d = build_driver()
+    pending = pending_rows(ws)
+    if ONLY_CODES:
+        pending = [(i, code) for i, code in pending if code in ONLY_CODES]
+    if not pending:
+        return
+
+    # Códigos repetidos en varias filas se consultan una sola vez
+    groups = defaultdict(list)
+    for i, code in pending:
+        groups[code].append(i)
+
+    cache = load_cache()
+    ts = now_bo()  # todas las filas de la corrida comparten la marca de tiempo
+    updates, unresolved = [], []
+    pool = DriverPool(min(WORKERS, len(groups)))
     try:
-        for i, row in enumerate(rows[1:], start=2):
-            code = (row[COL_CODE-1] if len(row) >= COL_CODE else "").strip()
-            done = (row[COL_DONE-1] if len(row) >= COL_DONE else "").strip().lower()
-            if not code or done == "ok":
-                continue
-
-            try:
-                status, when, carrier, obs = fetch_status_mailamericas(d, code)
-                ws.update(
-                    values=[[status or "", when or "", carrier or "", now_bo(), obs or ""]],
-                    range_name=f"{chr(64+COL_STATUS)}{i}:{chr(64+COL_OBS)}{i}"
-                )
-            except Exception as e:
-                ws.update(
-                    values=[[now_bo(), f"Error {type(e).__name__}"]],
-                    range_name=f"{chr(64+COL_UPDATED)}{i}:{chr(64+COL_OBS)}{i}"
-                )
+        with ThreadPoolExecutor(max_workers=pool.size) as ex:
+            jobs = ex.map(lambda g: _fetch_code(pool, g[0], g[1], cache.get(g[0]), ts), groups.items())
+            for code, (recs, entry, resolved) in zip(groups, jobs):
+                if not resolved:
+                    unresolved.append(code)
+                updates.extend(recs)
+                if entry:
+                    cache[code] = entry
+                elif resolved:
+                    # error o sin resultado: la próxima corrida debe volver a escribir las filas.
+                    # Los no resueltos conservan su entrada para el job con Chrome.
+                    cache.pop(code, None)
     finally:
-        try: d.quit()
-        except Exception: pass
+        pool.quit()
+        if updates:
+            flush_updates(ws, updates)
+        save_cache(cache)
+
+    if unresolved:
+        print(f"{len(unresolved)} código(s) requieren navegador: {', '.join(unresolved)}", file=sys.stderr)
+        # En Actions se publican como output para que el job con Chrome procese solo esos
+        gh_output = os.getenv("GITHUB_OUTPUT")
+        if gh_output:
+            with open(gh_output, "a", encoding="utf-8") as f:
+                f.write(f"unresolved={','.join(unresolved)}\n")
 
 if __name__ == "__main__":
     main()